@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
+import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
 from google import genai
 from google.genai import types
-from moviepy.editor import VideoFileClip, concatenate_videoclips
+# The ffmpeg stitching helpers live in stitch.py so both scripts share one copy
+from stitch import FFMPEG_BINARY, concat_videos_with_ffmpeg, have_matching_stream_formats, reencode_and_concat_videos
 from IPython.display import Video, display, Markdown
 
 # --- Configuration ---
@@ -13,15 +17,50 @@ LOCATION = "us-central1"            # @param {type:"string"}
 GCS_BUCKET_NAME = "storyboard_video_veo"  # @param {type:"string"}
 PROMPT_FOLDER = "final_prompts/"          # @param {type:"string"} # Optional: If prompts are in a subfolder
 LOCAL_WORKSPACE = "video_generation_workspace"
+# Veo writes finished clips here so the video bytes never have to be held in memory.
+# Each clip is deleted from GCS once it has been downloaded to LOCAL_WORKSPACE.
+VEO_OUTPUT_GCS_URI = f"gs://{GCS_BUCKET_NAME}/generated_scenes/"
+# Keep scene_N.mp4 and last_frame.png after the final movie is stitched (e.g. to re-run stitch.py)
+KEEP_INTERMEDIATES = False
 
 # --- Model Configuration ---
 video_model_text = "veo-3.0-generate-001"
 video_model_image = "veo-3.0-generate-preview"
 video_model_fast = "veo-3.0-fast-generate-001"
 
+# Shared by every scene; change settings like resolution or duration here
+VEO_VIDEO_CONFIG = types.GenerateVideosConfig(
+    aspect_ratio="16:9",
+    number_of_videos=1,
+    duration_seconds=8,
+    resolution="1080p",
+    person_generation="allow_adult",
+    enhance_prompt=True,
+    generate_audio=True,
+    output_gcs_uri=VEO_OUTPUT_GCS_URI,
+)
+
+# --- Polling Configuration ---
+# Delay between status checks starts at POLL_INITIAL_DELAY seconds and is multiplied
+# by POLL_BACKOFF_FACTOR after every check, capped at POLL_MAX_DELAY.
+POLL_INITIAL_DELAY = 2.0
+POLL_BACKOFF_FACTOR = 2.0
+POLL_MAX_DELAY = 30.0
+POLL_MAX_WAIT_SECONDS = 900  # Give up on a single Veo job after this long
+
+# Number of prompt files downloaded from GCS in parallel. The HTTP connection pool must
+# be at least this large (requests' default is 10), with headroom for other GCS calls.
+GCS_MAX_WORKERS = 16
+GCS_CONNECTION_POOL_SIZE = 64
+
 
 # --- Function Definitions ---
 
+def configure_connection_pool(storage_client, pool_size):
+    """Gives the GCS client a larger HTTP connection pool so parallel transfers don't wait on each other."""
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    storage_client._http.mount("https://", adapter)
+
 def initialize_clients():
     """Initializes and returns the Vertex AI and GCS clients."""
     print("Initializing clients...")
@@ -32,6 +71,7 @@ def initialize_clients():
     print(f"Using sanitized Project ID: '{cleaned_project_id}'")
     client = genai.Client(vertexai=True, project=cleaned_project_id, location=LOCATION)
     storage_client = storage.Client(project=cleaned_project_id)
+    configure_connection_pool(storage_client, GCS_CONNECTION_POOL_SIZE)
     print("Clients initialized successfully.")
     return client, storage_client
 
@@ -42,16 +82,18 @@ def get_prompts_from_gcs(storage_client, bucket_name, folder):
     # Ensure the folder name ends with a '/' if it's not empty
     if folder and not folder.endswith('/'):
         folder += '/'
-    blobs = list(bucket.list_blobs(prefix=folder))
-    
-    prompts = {}
-    for blob in blobs:
-        # Ensure we only read files and not the folder object itself
-        if blob.name.endswith(".txt"):
-            file_name = blob.name.split('/')[-1]
-            if file_name: # check if filename is not empty
-                content = blob.download_as_text()
-                prompts[file_name] = content
+    # Only the object names are needed here, so skip nested folders and ask GCS
+    # to return just the name field instead of full object metadata.
+    blobs = list(bucket.list_blobs(prefix=folder, delimiter='/', fields='items(name),nextPageToken'))
+
+    # Ensure we only read files and not the folder object itself
+    txt_blobs = [blob for blob in blobs if blob.name.endswith(".txt") and blob.name.split('/')[-1]]
+
+    # Downloads are network-bound, so fetch them concurrently instead of one at a time
+    with ThreadPoolExecutor(max_workers=GCS_MAX_WORKERS) as executor:
+        contents = list(executor.map(lambda blob: blob.download_as_text(), txt_blobs))
+
+    prompts = {blob.name.split('/')[-1]: content for blob, content in zip(txt_blobs, contents)}
             
     if not prompts:
          print(f"Warning: No .txt files found in gs://{bucket_name}/{folder}")
@@ -61,39 +103,58 @@ def get_prompts_from_gcs(storage_client, bucket_name, folder):
     print(f"Found and sorted {len(sorted_prompts)} prompts.")
     return sorted_prompts
 
-def generate_video_from_text(client, prompt, output_filename):
+def await_operation(client, operation, initial=POLL_INITIAL_DELAY, factor=POLL_BACKOFF_FACTOR,
+                    cap=POLL_MAX_DELAY, poll_max_wait_seconds=POLL_MAX_WAIT_SECONDS):
+    """
+    Polls a long-running operation until it is done, backing off exponentially
+    between checks so short jobs return quickly and long jobs make fewer calls.
+    """
+    deadline = time.monotonic() + poll_max_wait_seconds
+    delay = initial
+    while not operation.done:
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Operation did not complete within {poll_max_wait_seconds} seconds.")
+        print(f"Waiting for video generation to complete... (next check in {delay:.0f}s)")
+        time.sleep(delay)
+        operation = client.operations.get(operation)
+        delay = min(delay * factor, cap)
+    return operation
+
+def save_generated_video(storage_client, video, output_filename):
+    """
+    Saves a generated video to disk. Clips that Veo wrote to GCS are streamed
+    straight to the file and the GCS copy is then deleted; inline video bytes
+    are only used as a fallback.
+    """
+    if video.uri:
+        blob = storage.Blob.from_string(video.uri, client=storage_client)
+        blob.download_to_filename(output_filename)
+        blob.delete()
+    else:
+        with open(output_filename, "wb") as f:
+            f.write(video.video_bytes)
+
+def generate_video_from_text(client, storage_client, prompt, output_filename):
     """Generates a video from a text prompt and saves it."""
     print(f"Generating video for prompt: '{prompt[:50]}...'")
     operation = client.models.generate_videos(
         model=video_model_fast,
         prompt=prompt,
-        config=types.GenerateVideosConfig(
-            aspect_ratio="16:9",
-            number_of_videos=1,
-            duration_seconds=8,
-            resolution="1080p",
-            person_generation="allow_adult",
-            enhance_prompt=True,
-            generate_audio=True,
-        ),
+        config=VEO_VIDEO_CONFIG,
     )
-    
-    while not operation.done:
-        print("Waiting for video generation to complete...")
-        time.sleep(20)
-        operation = client.operations.get(operation)
+
+    operation = await_operation(client, operation)
 
     if operation.response:
-        video_bytes = operation.result.generated_videos[0].video.video_bytes
-        with open(output_filename, "wb") as f:
-            f.write(video_bytes)
+        video = operation.result.generated_videos[0].video
+        save_generated_video(storage_client, video, output_filename)
         print(f"Video saved to {output_filename}")
         return output_filename
     else:
         raise Exception("Video generation failed. The operation completed without a response.")
 
 # --- Generae Video from image and text ---
-def generate_video_from_image_and_text(client, prompt, image_path, output_filename):
+def generate_video_from_image_and_text(client, storage_client, prompt, image_path, output_filename):
     """
     Generates a video from an image and text prompt using the correct
     types.Image.from_file() method.
@@ -104,26 +165,14 @@ def generate_video_from_image_and_text(client, prompt, image_path, output_filena
         model=video_model_image,
         prompt=prompt,
         image=types.Image.from_file(location=image_path),
-        config=types.GenerateVideosConfig(
-            aspect_ratio="16:9",
-            number_of_videos=1,
-            duration_seconds=8,
-            resolution="1080p",
-            person_generation="allow_adult",
-            enhance_prompt=True,
-            generate_audio=True,
-        ),
+        config=VEO_VIDEO_CONFIG,
     )
 
-    while not operation.done:
-        print("Waiting for video generation to complete...")
-        time.sleep(20)
-        operation = client.operations.get(operation)
-        
+    operation = await_operation(client, operation)
+
     if operation.response:
-        video_bytes = operation.result.generated_videos[0].video.video_bytes
-        with open(output_filename, "wb") as f:
-            f.write(video_bytes)
+        video = operation.result.generated_videos[0].video
+        save_generated_video(storage_client, video, output_filename)
         print(f"Video saved to {output_filename}")
         return output_filename
     else:
@@ -137,8 +186,14 @@ def extract_last_frame(video_path, output_image_path):
     """
     print(f"Extracting last frame from {video_path}...")
     try:
-        with VideoFileClip(video_path) as clip:
-            clip.save_frame(output_image_path, t=clip.duration - 0.1)
+        # -sseof seeks relative to the end of the input, so ffmpeg only decodes
+        # the tail of the clip instead of opening and walking the whole file.
+        subprocess.run(
+            [FFMPEG_BINARY, "-y", "-loglevel", "error", "-sseof", "-0.1", "-i", video_path,
+             "-frames:v", "1", "-q:v", "2", output_image_path],
+            check=True,
+            capture_output=True,
+        )
 
         # --- VALIDATION STEP ---
         # Check if the file was actually created and is not empty
@@ -147,37 +202,48 @@ def extract_last_frame(video_path, output_image_path):
             
         print(f"Successfully extracted last frame to {output_image_path} (Size: {os.path.getsize(output_image_path)} bytes)")
 
+    except subprocess.CalledProcessError as e:
+        print(f"ffmpeg failed during frame extraction: {e.stderr.decode(errors='replace').strip()}")
+        raise
     except Exception as e:
-        print(f"An error occurred during frame extraction with moviepy: {e}")
+        print(f"An error occurred during frame extraction with ffmpeg: {e}")
         raise
 
 def stitch_videos(video_paths, final_output_path):
     """Stitches multiple video clips into one."""
     print("Stitching all generated scenes together...")
-    clips = [VideoFileClip(path) for path in video_paths]
-    final_clip = concatenate_videoclips(clips, method="compose")
-    final_clip.write_videofile(final_output_path, codec="libx264", audio_codec="aac")
-    
-    for clip in clips:
-        clip.close()
+    # Veo scenes normally share codec, resolution and frame rate, so the streams can be copied
+    if have_matching_stream_formats(video_paths):
+        try:
+            concat_videos_with_ffmpeg(video_paths, final_output_path)
+            print(f"Final video saved to {final_output_path}")
+            return final_output_path
+        except subprocess.CalledProcessError as e:
+            print(f"Stream copy failed, re-encoding instead: {e.stderr.decode(errors='replace').strip()}")
+    else:
+        print("Scenes have different stream formats, re-encoding them with MoviePy...")
+
+    reencode_and_concat_videos(video_paths, final_output_path)
     
     print(f"Final video saved to {final_output_path}")
     return final_output_path
 
-def main():
-    """Main function to run the video generation workflow."""
-    if not os.path.exists(LOCAL_WORKSPACE):
-        os.makedirs(LOCAL_WORKSPACE)
-        
-    client, storage_client = initialize_clients()
-    prompts = get_prompts_from_gcs(storage_client, GCS_BUCKET_NAME, PROMPT_FOLDER)
-    
-    if not prompts:
-        print("No prompts found in the specified GCS location. Exiting.")
-        return
+def remove_intermediate_files(paths):
+    """Deletes the per-scene clips and chaining frame once the final movie has been written."""
+    removed = 0
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    print(f"Removed {removed} intermediate files from {LOCAL_WORKSPACE}")
 
+def generate_scenes(client, storage_client, prompts):
+    """
+    Generates every scene, chaining each one off the last frame of the previous scene.
+    """
     generated_scene_paths = []
     last_frame_image_path = os.path.join(LOCAL_WORKSPACE, "last_frame.png")
+    previous_video_path = None
 
     for i, prompt in enumerate(prompts):
         scene_number = i + 1
@@ -185,18 +251,39 @@ def main():
         
         print(f"\n--- Processing Scene {scene_number} ---")
         
-        if i == 0:
-            generate_video_from_text(client, prompt, output_video_path)
+        if previous_video_path is None:
+            generate_video_from_text(client, storage_client, prompt, output_video_path)
         else:
-            previous_video_path = generated_scene_paths[i-1]
             extract_last_frame(previous_video_path, last_frame_image_path)
-            generate_video_from_image_and_text(client, prompt, last_frame_image_path, output_video_path)
-            
+            generate_video_from_image_and_text(client, storage_client, prompt, last_frame_image_path, output_video_path)
+
+        # Each scene only depends on the one before it; the full list is just for stitching
+        previous_video_path = output_video_path
         generated_scene_paths.append(output_video_path)
 
+    return generated_scene_paths
+
+def main():
+    """Main function to run the video generation workflow."""
+    if not os.path.exists(LOCAL_WORKSPACE):
+        os.makedirs(LOCAL_WORKSPACE)
+        
+    client, storage_client = initialize_clients()
+    prompts = get_prompts_from_gcs(storage_client, GCS_BUCKET_NAME, PROMPT_FOLDER)
+    
+    if not prompts:
+        print("No prompts found in the specified GCS location. Exiting.")
+        return
+
+    generated_scene_paths = generate_scenes(client, storage_client, prompts)
+
     if generated_scene_paths:
         final_video_path = os.path.join(LOCAL_WORKSPACE, "final_movie.mp4")
         stitch_videos(generated_scene_paths, final_video_path)
+
+        if not KEEP_INTERMEDIATES:
+            last_frame_image_path = os.path.join(LOCAL_WORKSPACE, "last_frame.png")
+            remove_intermediate_files(generated_scene_paths + [last_frame_image_path])
         
         print("\n--- Final Movie ---")
         display(Video(final_video_path, embed=True, width=800))
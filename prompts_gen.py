@@ -1,18 +1,26 @@
 import google.generativeai as genai
 from google.cloud import storage
-import os
+from requests.adapters import HTTPAdapter
 import json
-import time
-import tempfile
+import asyncio
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuration ---
 GCP_PROJECT_ID = "<GCP_PROJECT_ID>"
 GCS_BUCKET_NAME = "<GCS_BUCKET_NAME>" 
 GEMINI_API_KEY = "<GEMINI_API_KEY>"
+GCS_MAX_WORKERS = 16  # Number of prompt files uploaded to GCS in parallel
+GCS_CONNECTION_POOL_SIZE = 64  # Must be >= GCS_MAX_WORKERS (requests' default pool is 10)
+GEMINI_MODEL_NAME = "gemini-2.5-pro"
+CACHE_GCS_FOLDER = "intermediate_assets/cache/"  # Results of Steps 1 and 2, keyed by their inputs
 
 # --- Initialization ---
 genai.configure(api_key=GEMINI_API_KEY)
 storage_client = storage.Client(project=GCP_PROJECT_ID)
+# Widen the client's HTTP connection pool so the parallel Step 3 uploads don't queue for a connection
+storage_client._http.mount("https://", HTTPAdapter(pool_connections=GCS_CONNECTION_POOL_SIZE, pool_maxsize=GCS_CONNECTION_POOL_SIZE))
 
 # --- GCS Helper Functions ---
 def upload_string_to_gcs(bucket_name, source_data, destination_blob_name, content_type='text/plain'):
@@ -26,47 +34,49 @@ def upload_string_to_gcs(bucket_name, source_data, destination_blob_name, conten
         print(f"Error uploading to GCS: {e}")
         raise
 
-def download_from_gcs(bucket_name, source_blob_name):
-    """Downloads data from a GCS bucket and returns it as bytes for JSON loading."""
+def download_text_from_gcs(bucket_name, source_blob_name):
+    """Downloads a text file from a GCS bucket and returns it as a string."""
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(source_blob_name)
-        return blob.download_as_bytes()
+        return blob.download_as_text()
     except Exception as e:
         print(f"Error downloading from GCS: {e}")
         raise
 
+# --- Cache Helper Functions ---
+def make_cache_key(*parts):
+    """Builds a cache key from everything that determines a Gemini step's output."""
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+def restore_cached_result(cache_key, output_gcs_path):
+    """If a cached result exists for this key, copies it to output_gcs_path and returns True."""
+    bucket = storage_client.bucket(GCS_BUCKET_NAME)
+    cached_blob = bucket.blob(f"{CACHE_GCS_FOLDER}{cache_key}.json")
+    if not cached_blob.exists():
+        return False
+    bucket.copy_blob(cached_blob, bucket, output_gcs_path)
+    print(f"Reused cached result gs://{GCS_BUCKET_NAME}/{cached_blob.name} for {output_gcs_path}")
+    return True
+
+def store_cached_result(cache_key, output_gcs_path):
+    """Copies a freshly generated result into the cache under the given key."""
+    bucket = storage_client.bucket(GCS_BUCKET_NAME)
+    bucket.copy_blob(bucket.blob(output_gcs_path), bucket, f"{CACHE_GCS_FOLDER}{cache_key}.json")
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking SDK call in the default executor so concurrent steps keep progressing."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
 # --- Pipeline Step Functions ---
 
-def step1_analyze_video_in_chunks(gcs_video_uri, output_gcs_path, chunk_duration=8):
+async def step1_analyze_video_in_chunks(gcs_video_uri, output_gcs_path, chunk_duration=8):
     """
-    Uses the robust download-then-upload method to handle the video.
+    Streams the video from GCS straight into the Gemini Files API, without a local temp file.
     """
     print("--- Starting Step 1: Analyze Video in Time-Based Chunks ---")
-    temp_local_filename = None
-    try:
-        blob_name = gcs_video_uri.replace(f"gs://{GCS_BUCKET_NAME}/", "")
-        _, temp_local_filename = tempfile.mkstemp(suffix=".mp4")
-        print(f"Downloading {gcs_video_uri} to temporary file: {temp_local_filename}...")
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(blob_name)
-        blob.download_to_filename(temp_local_filename)
-        print("Download complete.")
-
-        print("Uploading temporary file to Gemini for processing...")
-        video_file = genai.upload_file(path=temp_local_filename)
-        
-        print("File upload initiated. Waiting for processing to complete...")
-        while video_file.state.name == "PROCESSING":
-            print("... Checking status in 10 seconds ...")
-            time.sleep(10)
-            video_file = genai.get_file(name=video_file.name)
-
-        if video_file.state.name == "FAILED":
-            raise ValueError(f"Video processing failed: {video_file.error}")
-        print("Video processed successfully!")
-
-        prompt = """
+    prompt = """
     Analyze the provided storyboard video. Deconstruct it into a detailed, scene-by-scene breakdown.
     For each scene, provide the following in a JSON object:
     - scene_number: A sequential integer.
@@ -78,29 +88,52 @@ def step1_analyze_video_in_chunks(gcs_video_uri, output_gcs_path, chunk_duration
     - camera_shot: Description of camera angle, shot type, and movement.
     Ensure the output is a single, valid JSON array of scenes.
     """
-        model = genai.GenerativeModel(model_name="gemini-2.5-pro")
-        response = model.generate_content(
-            [prompt, video_file],
-            generation_config=genai.types.GenerationConfig(response_mime_type="application/json"),
-            request_options={"timeout": 600}
-        )
-        
-        upload_string_to_gcs(GCS_BUCKET_NAME, response.text, output_gcs_path, content_type='application/json')
-        genai.delete_file(name=video_file.name)
-        print(f"Cleaned up processed file from Gemini service.")
-    finally:
-        if temp_local_filename and os.path.exists(temp_local_filename):
-            os.remove(temp_local_filename)
-            print(f"Deleted temporary local file: {temp_local_filename}")
+    blob_name = gcs_video_uri.replace(f"gs://{GCS_BUCKET_NAME}/", "")
+    bucket = storage_client.bucket(GCS_BUCKET_NAME)
+    blob = bucket.blob(blob_name)
+
+    # Skip the analysis if this exact video was already analyzed with the same prompt and model
+    await run_blocking(blob.reload)
+    cache_key = make_cache_key(prompt, blob.crc32c, GEMINI_MODEL_NAME)
+    if await run_blocking(restore_cached_result, cache_key, output_gcs_path):
+        print("--- Finished Step 1 ---")
+        return
+
+    # The Gemini API-key client can't read gs:// URIs, so hand it a GCS read stream instead
+    print(f"Streaming {gcs_video_uri} to Gemini for processing...")
+    with blob.open("rb") as video_stream:
+        video_file = await run_blocking(genai.upload_file, video_stream, mime_type="video/mp4", display_name=blob_name)
+
+    print("File upload initiated. Waiting for processing to complete...")
+    while video_file.state.name == "PROCESSING":
+        print("... Checking status in 10 seconds ...")
+        await asyncio.sleep(10)
+        video_file = await run_blocking(genai.get_file, name=video_file.name)
+
+    if video_file.state.name == "FAILED":
+        raise ValueError(f"Video processing failed: {video_file.error}")
+    print("Video processed successfully!")
+
+    model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
+    response = await model.generate_content_async(
+        [prompt, video_file],
+        generation_config=genai.types.GenerationConfig(response_mime_type="application/json"),
+        request_options={"timeout": 600}
+    )
+    
+    await run_blocking(upload_string_to_gcs, GCS_BUCKET_NAME, response.text, output_gcs_path, content_type='application/json')
+    await run_blocking(store_cached_result, cache_key, output_gcs_path)
+    await run_blocking(genai.delete_file, name=video_file.name)
+    print(f"Cleaned up processed file from Gemini service.")
     print("--- Finished Step 1 ---")
 
 
-def step2_generate_character_descriptions(output_gcs_path):
+async def step2_generate_character_descriptions(output_gcs_path):
     """
     Generates character descriptions and saves them as a JSON file to GCS.
     """
     print("\n--- Starting Step 2: Generate Character Descriptions ---")
-    model = genai.GenerativeModel(model_name="gemini-2.5-pro")
+    model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
     prompt = """Create detailed character descriptions for Dracula from the 'Hotel Transylvania' movie franchise for a new animated short.
     The output must be a JSON object with two keys: "dracula" and "martha".
     For each character, detail their:
@@ -110,8 +143,16 @@ def step2_generate_character_descriptions(output_gcs_path):
     - voice_style: Tone and speaking patterns.
     - For Martha's character from the 'Hotel Transylvania" movie franchise consider Martha as a beautiful female vampire with long, wavy black hair and bright blue eyes. She is slender and pale-skinned, often seen wearing a black long-sleeved dress and a black choker. She also sports black shoes and sometimes has black lipstick and nail polish. 
     """
-    response = model.generate_content(prompt, generation_config=genai.types.GenerationConfig(response_mime_type="application/json"))
-    upload_string_to_gcs(GCS_BUCKET_NAME, response.text, output_gcs_path, content_type='application/json')
+
+    # The prompt is fixed, so the descriptions only need regenerating when the prompt or model changes
+    cache_key = make_cache_key(prompt, GEMINI_MODEL_NAME)
+    if await run_blocking(restore_cached_result, cache_key, output_gcs_path):
+        print("--- Finished Step 2 ---")
+        return
+
+    response = await model.generate_content_async(prompt, generation_config=genai.types.GenerationConfig(response_mime_type="application/json"))
+    await run_blocking(upload_string_to_gcs, GCS_BUCKET_NAME, response.text, output_gcs_path, content_type='application/json')
+    await run_blocking(store_cached_result, cache_key, output_gcs_path)
     print("--- Finished Step 2 ---")
 
 
@@ -123,9 +164,9 @@ def step3_generate_and_upload_separate_prompts(chunk_analysis_gcs_path, characte
     """
     print("\n--- Starting Step 3: Generate and Upload Separate Prompts ---")
     
-    chunk_json_bytes = download_from_gcs(GCS_BUCKET_NAME, chunk_analysis_gcs_path)
-    character_json_bytes = download_from_gcs(GCS_BUCKET_NAME, characters_gcs_path)
-    model = genai.GenerativeModel(model_name="gemini-2.5-pro")
+    chunk_json_text = download_text_from_gcs(GCS_BUCKET_NAME, chunk_analysis_gcs_path)
+    character_json_text = download_text_from_gcs(GCS_BUCKET_NAME, characters_gcs_path)
+    model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
 
     # Prompt
     prompt = f"""
@@ -133,10 +174,10 @@ def step3_generate_and_upload_separate_prompts(chunk_analysis_gcs_path, characte
     Use the provided video chunk analysis and the new character descriptions.
 
     **Character Descriptions to Embed:**
-    {character_json_bytes.decode('utf-8')}
+    {character_json_text}
 
     **Original Video Chunk Analysis:**
-    {chunk_json_bytes.decode('utf-8')}
+    {chunk_json_text}
 
     **Instructions:**
     For each chunk in the analysis, create a JSON object with a single key: "veo_prompt".
@@ -163,7 +204,7 @@ def step3_generate_and_upload_separate_prompts(chunk_analysis_gcs_path, characte
     print("Generation complete. Parsing response and uploading individual prompt files...")
     prompts_data = json.loads(response.text)
 
-    uploaded_count = 0
+    uploads = []
     for i, item in enumerate(prompts_data):
         prompt_text = None
         # Check if the item is a dictionary and has the 'veo_prompt' key
@@ -184,14 +225,32 @@ def step3_generate_and_upload_separate_prompts(chunk_analysis_gcs_path, characte
         # Create the full path in the GCS bucket folder
         destination_blob_name = f"{output_gcs_folder}{destination_filename}"
 
-        # Upload the single prompt string to the new file
-        upload_string_to_gcs(GCS_BUCKET_NAME, prompt_text, destination_blob_name)
-        uploaded_count += 1
+        uploads.append((destination_blob_name, prompt_text))
+
+    # Each upload is a separate blocking request, so send them concurrently.
+    # Consuming the map re-raises the first upload error, if any.
+    with ThreadPoolExecutor(max_workers=GCS_MAX_WORKERS) as executor:
+        list(executor.map(
+            lambda upload: upload_string_to_gcs(GCS_BUCKET_NAME, upload[1], upload[0]),
+            uploads,
+        ))
+    uploaded_count = len(uploads)
         
     print(f"--- Finished Step 3: Uploaded {uploaded_count} prompt files. ---")
 
 
 # --- Main Pipeline Controller ---
+async def run_analysis_steps(gcs_video_uri, chunk_analysis_path, character_descriptions_path):
+    """
+    Runs Step 1 and Step 2 concurrently. Neither depends on the other's output,
+    so the pipeline only waits for the slower of the two before Step 3.
+    """
+    await asyncio.gather(
+        step1_analyze_video_in_chunks(gcs_video_uri, chunk_analysis_path),
+        step2_generate_character_descriptions(character_descriptions_path),
+    )
+
+
 def run_prompt_generation_pipeline(source_video_filename):
     """
     Executes the entire automated pipeline to generate prompts as separate files.
@@ -202,11 +261,8 @@ def run_prompt_generation_pipeline(source_video_filename):
     final_prompts_gcs_folder = "final_prompts/"
 
     try:
-        # Step 1: Analyze the source video into chunks
-        step1_analyze_video_in_chunks(gcs_video_uri, chunk_analysis_path)
-        
-        # Step 2: Create the character sheets
-        step2_generate_character_descriptions(character_descriptions_path)
+        # Step 1 and Step 2: Analyze the source video into chunks while creating the character sheets
+        asyncio.run(run_analysis_steps(gcs_video_uri, chunk_analysis_path, character_descriptions_path))
 
         # Step 3: Final combined prompt and store in gcs
         step3_generate_and_upload_separate_prompts(
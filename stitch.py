@@ -1,6 +1,11 @@
+import json
 import os
 import re
-from moviepy.editor import VideoFileClip, concatenate_videoclips
+import subprocess
+import tempfile
+import numpy as np
+from moviepy.config import get_setting
+from moviepy.editor import AudioClip, VideoFileClip
 
 # --- USER CONFIGURATION ---
 
@@ -14,6 +19,114 @@ FINAL_OUTPUT_FILE = 'final_animated_short.mp4'
 
 # --- END OF CONFIGURATION ---
 
+# Reuse the ffmpeg binary MoviePy already resolved
+FFMPEG_BINARY = get_setting("FFMPEG_BINARY")
+# x264 preset for the re-encode fallback; "veryfast" is several times quicker than the default "medium"
+FALLBACK_ENCODE_PRESET = "veryfast"
+# Sample rate of the silent track given to clips without audio; matches write_videofile's default audio_fps
+SILENT_AUDIO_FPS = 44100
+# MoviePy's bundled ffmpeg doesn't include ffprobe, so it is looked up on the PATH
+FFPROBE_BINARY = "ffprobe"
+# Stream properties that must be identical across clips for a concat stream copy to be valid
+STREAM_FORMAT_FIELDS = ("codec_type", "codec_name", "pix_fmt", "width", "height", "r_frame_rate", "sample_rate", "channels")
+
+# Finds the first sequence of digits in a clip filename, e.g. the 3 in 'scene_3.mp4'
+SCENE_NUMBER_RE = re.compile(r'(\d+)')
+
+
+def get_scene_number(filename):
+    """Returns the scene number embedded in a clip filename, or -1 if there is none."""
+    match = SCENE_NUMBER_RE.search(filename)
+    return int(match.group(1)) if match else -1
+
+
+def probe_stream_formats(path):
+    """Returns the STREAM_FORMAT_FIELDS of every stream in a clip, in stream order, using ffprobe."""
+    result = subprocess.run(
+        [FFPROBE_BINARY, "-v", "error", "-show_entries", "stream=" + ",".join(STREAM_FORMAT_FIELDS),
+         "-of", "json", path],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    streams = json.loads(result.stdout).get("streams", [])
+    return tuple(tuple(stream.get(field) for field in STREAM_FORMAT_FIELDS) for stream in streams)
+
+
+def have_matching_stream_formats(video_paths):
+    """
+    Returns True if every clip has the same streams with the same codecs, pixel format,
+    resolution, frame rate, sample rate and channel count, so they can be joined with a
+    stream copy. Returns False if the clips can't be probed, so callers re-encode instead.
+    """
+    try:
+        formats = {probe_stream_formats(path) for path in video_paths}
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Could not probe the clip formats with ffprobe, so they will be re-encoded: {e}")
+        return False
+    return len(formats) == 1
+
+
+def concat_videos_with_ffmpeg(video_paths, output_filename):
+    """
+    Joins clips with ffmpeg's concat demuxer, copying the streams as-is
+    instead of decoding and re-encoding every frame.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as list_file:
+        for path in video_paths:
+            escaped_path = os.path.abspath(path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped_path}'\n")
+    try:
+        subprocess.run(
+            [FFMPEG_BINARY, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_file.name, "-c", "copy", "-movflags", "+faststart", output_filename],
+            check=True,
+            capture_output=True,
+        )
+    finally:
+        os.remove(list_file.name)
+
+
+def make_silent_frame(t):
+    """Stereo silence for MoviePy's AudioClip; t is a single time or an array of times."""
+    return np.zeros((len(t), 2)) if isinstance(t, np.ndarray) else np.zeros(2)
+
+
+def reencode_and_concat_videos(video_paths, output_filename):
+    """
+    Fallback for clips whose formats differ. Each clip is opened on its own,
+    re-encoded to the first clip's size and frame rate, and closed before the
+    next one is read; the uniform parts are then joined with a stream copy.
+    Clips of another size are scaled to fit and letterboxed in black, so their
+    aspect ratio is kept, and clips without audio get a silent track so every
+    part has the same streams.
+    """
+    target_size = target_fps = None
+    with tempfile.TemporaryDirectory() as parts_dir:
+        part_paths = []
+        for i, path in enumerate(video_paths):
+            with VideoFileClip(path, fps_source="tbr") as clip:
+                if target_size is None:
+                    target_size, target_fps = clip.size, clip.fps
+                part = clip
+                if clip.size != target_size:
+                    scale = min(target_size[0] / clip.w, target_size[1] / clip.h)
+                    part = clip.resize(scale).on_color(size=target_size, color=(0, 0, 0), pos="center")
+                if clip.audio is None:
+                    part = part.set_audio(AudioClip(make_silent_frame, duration=clip.duration, fps=SILENT_AUDIO_FPS))
+                part_path = os.path.join(parts_dir, f"part_{i:03d}.mp4")
+                part.write_videofile(
+                    part_path,
+                    fps=target_fps,
+                    codec="libx264",
+                    audio_codec="aac",
+                    preset=FALLBACK_ENCODE_PRESET,
+                    threads=os.cpu_count(),
+                    logger=None,
+                )
+            part_paths.append(part_path)
+        concat_videos_with_ffmpeg(part_paths, output_filename)
+
 
 def stitch_videos(clips_folder, output_filename):
     """
@@ -36,34 +149,31 @@ def stitch_videos(clips_folder, output_filename):
         return
 
     # --- IMPORTANT: Sort the clips numerically based on the numbers in their filenames ---
-    def get_scene_number(filename):
-        # This regular expression finds the first sequence of digits in the filename
-        match = re.search(r'(\d+)', filename)
-        return int(match.group(1)) if match else -1
-
     clip_files.sort(key=get_scene_number)
     
     print("\nFound and sorted the following clips to be stitched:")
     for clip_name in clip_files:
         print(f"  -> {clip_name}")
 
-    try:
-        # Create a list of VideoFileClip objects
-        print("\nLoading clips into memory...")
-        video_clips = [VideoFileClip(os.path.join(clips_folder, f)) for f in clip_files]
-
-        # Concatenate the clips into one long clip
-        print("Stitching clips together...")
-        final_clip = concatenate_videoclips(video_clips, method="compose")
+    clip_paths = [os.path.join(clips_folder, f) for f in clip_files]
 
-        # Write the final movie to a file
+    try:
+        # Generated scenes normally share codec, resolution and frame rate, so try a stream copy first
+        if have_matching_stream_formats(clip_paths):
+            print("\nClips share the same format. Joining them without re-encoding...")
+            try:
+                concat_videos_with_ffmpeg(clip_paths, output_filename)
+                print("\n--- SCRIPT FINISHED SUCCESSFULLY! ---")
+                print(f"Your final movie has been saved as: {output_filename}")
+                return
+            except subprocess.CalledProcessError as e:
+                print(f"Stream copy failed, falling back to re-encoding: {e.stderr.decode(errors='replace').strip()}")
+        else:
+            print("\nClips have different formats, so they will be re-encoded.")
+
+        # Re-encode the clips one at a time so only a single clip is held open
         print(f"Writing final movie to '{output_filename}'... (This may take a moment)")
-        final_clip.write_videofile(output_filename, codec="libx264", audio_codec="aac")
-        
-        # Close all clips to release memory and file handles
-        for clip in video_clips:
-            clip.close()
-        final_clip.close()
+        reencode_and_concat_videos(clip_paths, output_filename)
         
         print("\n--- SCRIPT FINISHED SUCCESSFULLY! ---")
         print(f"Your final movie has been saved as: {output_filename}")